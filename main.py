@@ -3,59 +3,164 @@
 
 import os
 import json
+import logging
 import asyncio
-from typing import List, Dict, Any, Set
+import signal
+import base64
+import mmap
+import struct
+import sys
+from bisect import bisect_left, insort
+from typing import List, Dict, Any, Mapping, Optional, Set, Tuple
 
 from aiohttp import web
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramAPIError
 from aiogram.filters import CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, Message
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+
+    def json_dumps_line(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+except ImportError:
+    def json_loads(data: Any) -> Any:
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
+
+    def json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+    def json_dumps_line(obj: Any) -> bytes:
+        return json_dumps(obj) + b"\n"
+
+def json_dumps_str(obj: Any) -> str:
+    return json_dumps(obj).decode("utf-8")
+
 TOKEN = os.getenv("BOT_TOKEN")
 WEBHOOK_URL = os.getenv("RENDER_EXTERNAL_URL", "").rstrip("/") + "/webhook"
 QUESTIONS_FILE = os.getenv("QUESTIONS_FILE", "questions.json")
-RESULTS_FILE = os.getenv("RESULTS_FILE", "results.json")
+RESULTS_FILE = os.getenv("RESULTS_FILE", "results.jsonl")
 PORT = int(os.getenv("PORT", "10000"))
 LEADERS_TOP_N = int(os.getenv("LEADERS_TOP_N", "10"))
+REDIS_URL = os.getenv("REDIS_URL")
 
 def load_questions(path: str) -> List[Dict[str, Any]]:
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        with memoryview(mm) as view:
+            qs = json_loads(view)
+    for qid, q in enumerate(qs):
+        aidx = q["answer_index"]
+        q["_correct_bits"] = sum(1 << i for i in (aidx if isinstance(aidx, list) else [aidx]))
+        if q["type"] == "single":
+            q["_kb_single"] = kb_single(q["options"], qid)
+        else:
+            q["_kb_multi_off"] = multi_rows(q["options"], qid)
+            q["_kb_multi_on"] = multi_rows(q["options"], qid, "✅ ")
+            q["_kb_multi_done"] = [InlineKeyboardButton(text="➡️ Готово", callback_data=answer_data(ACT_DONE, qid))]
+    return qs
+
+# created in main(): before Python 3.10 a Queue binds to the loop current at creation
+_results_queue: Optional["asyncio.Queue[Dict[str, Any]]"] = None
+# best (score, total) per name and the current top LEADERS_TOP_N as sorted
+# (-score, lowercased name, name, total) tuples
+_best: Dict[str, Tuple[int, int]] = {}
+_top: List[Tuple[int, str, str, int]] = []
+# bumped whenever _top may have changed; get_leaderboard caches against it
+_lb_version = 0
+_lb_cache: Tuple[Any, str] = (None, "")
 
 def load_results(path: str) -> List[Dict[str, Any]]:
     if not os.path.exists(path):
         return []
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
-
-def save_results(path: str, results: List[Dict[str, Any]]):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(results, f, ensure_ascii=False, indent=2)
-
-def get_leaderboard(path: str, top_n: int) -> str:
-    results = load_results(path)
-    if not results:
-        return "Пока нет результатов 😅"
-    best = {}
-    for r in results:
-        n = r.get("name", "Без имени")
-        s = int(r.get("score", 0))
-        t = int(r.get("total", 0))
-        if n not in best or s > best[n]["score"]:
-            best[n] = {"score": s, "total": t}
-    table = sorted(best.items(), key=lambda kv: (-kv[1]["score"], kv[0].lower()))
-    lines = ["🏆 Рейтинг:"]
-    for i, (n, st) in enumerate(table[:top_n], 1):
-        lines.append(f"{i}. {n} — {st['score']}/{st['total']}")
-    return "\n".join(lines)
+    with open(path, "rb") as f:
+        raw = f.read()
+    if raw.lstrip().startswith(b"["):
+        # results.json used to be a single JSON array; rewrite it as JSONL once
+        records = json_loads(raw)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.writelines(json_dumps_line(r) for r in records)
+        os.replace(tmp, path)
+        return records
+    return [json_loads(line) for line in raw.splitlines() if line.strip()]
 
-questions = load_questions(QUESTIONS_FILE)
+def record_best(record: Dict[str, Any]):
+    global _lb_version
+    n = record.get("name", "Без имени")
+    s = int(record.get("score", 0))
+    t = int(record.get("total", 0))
+    prev = _best.get(n)
+    if prev is not None and s <= prev[0]:
+        return
+    _best[n] = (s, t)
+    ln = n.lower()
+    if prev is not None:
+        old = (-prev[0], ln, n, prev[1])
+        i = bisect_left(_top, old)
+        if i < len(_top) and _top[i] == old:
+            del _top[i]
+    insort(_top, (-s, ln, n, t))
+    del _top[LEADERS_TOP_N:]
+    _lb_version += 1
+
+def open_results(path: str):
+    global _lb_version
+    _best.clear()
+    _top.clear()
+    _lb_version += 1
+    for r in load_results(path):
+        record_best(r)
+
+def write_lines(fp, lines: List[bytes]):
+    fp.writelines(lines)
+    fp.flush()
+
+async def results_writer(path: str, queue: "asyncio.Queue[Dict[str, Any]]"):
+    with open(path, "ab", buffering=64 * 1024) as fp:
+        while True:
+            batch = [json_dumps_line(await queue.get())]
+            while not queue.empty():
+                batch.append(json_dumps_line(queue.get_nowait()))
+            # the disk write itself runs in a worker thread, off the event loop
+            await asyncio.to_thread(write_lines, fp, batch)
+            for _ in batch:
+                queue.task_done()
+
+def writer_done(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error("results writer stopped, results are no longer saved", exc_info=task.exception())
+
+def append_result(record: Dict[str, Any]):
+    record_best(record)
+    _results_queue.put_nowait(record)
+
+def get_leaderboard() -> str:
+    # shows at most LEADERS_TOP_N names, the size _top is trimmed to
+    global _lb_cache
+    if _lb_cache[0] == _lb_version:
+        return _lb_cache[1]
+    if not _top:
+        text = "Пока нет результатов 😅"
+    else:
+        lines = ["🏆 Рейтинг:"]
+        for i, (s, _, n, t) in enumerate(_top, 1):
+            lines.append(f"{i}. {n} — {-s}/{t}")
+        text = "\n".join(lines)
+    _lb_cache = (_lb_version, text)
+    return text
 
 class Quiz(StatesGroup):
     name = State()
@@ -69,27 +174,54 @@ def kb_start():
         [InlineKeyboardButton(text="🏆 Рейтинг", callback_data="show_rating")]
     ])
 
+# answer buttons carry (action, qid, option) packed into 4 bytes, base64 without padding
+ACT_SINGLE, ACT_MULTI, ACT_DONE = 1, 2, 3
+ANSWER_DATA = struct.Struct("<BHB")
+
+def answer_data(action: int, qid: int, idx: int = 0) -> str:
+    return base64.urlsafe_b64encode(ANSWER_DATA.pack(action, qid, idx)).rstrip(b"=").decode("ascii")
+
 def kb_single(opts, qid):
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=o, callback_data=f"s:{qid}:{i}")] for i, o in enumerate(opts)
+        [InlineKeyboardButton(text=o, callback_data=answer_data(ACT_SINGLE, qid, i))] for i, o in enumerate(opts)
     ])
 
-def kb_multi(opts, qid, sel: Set[int]):
-    rows = []
-    for i, o in enumerate(opts):
-        mark = "✅ " if i in sel else ""
-        rows.append([InlineKeyboardButton(text=f"{mark}{o}", callback_data=f"m:{qid}:{i}")])
-    rows.append([InlineKeyboardButton(text="➡️ Готово", callback_data=f"m_done:{qid}")])
+def multi_rows(opts, qid, mark=""):
+    return [[InlineKeyboardButton(text=f"{mark}{o}", callback_data=answer_data(ACT_MULTI, qid, i))] for i, o in enumerate(opts)]
+
+def kb_multi(q, sel_mask: int):
+    rows = [on if sel_mask & (1 << i) else off
+            for i, (off, on) in enumerate(zip(q["_kb_multi_off"], q["_kb_multi_on"]))]
+    rows.append(q["_kb_multi_done"])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
+questions = load_questions(QUESTIONS_FILE)
+# one point per question, whether single or multi
+QUIZ_TOTAL = len(questions)
+
+STALE_BUTTON_TEXT = "Кнопка устарела"
+_background: Set[asyncio.Task] = set()
+
+async def _answer(callback: CallbackQuery, text: Optional[str]):
+    try:
+        await callback.answer(text)
+    except TelegramAPIError:
+        # a lost ack only leaves the button spinner on until Telegram drops it
+        pass
+
+def answer_later(callback: CallbackQuery, text: Optional[str] = None):
+    task = asyncio.create_task(_answer(callback, text))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
 @router.message(CommandStart())
 async def cmd_start(msg: Message, state: FSMContext):
     await msg.answer("🎂 Привет! Это викторина про дедушку Серёжу 🎉\nКто знает его лучше всех? 🏆", reply_markup=kb_start())
 
 @router.callback_query(F.data == "show_rating")
 async def show_rating(callback: CallbackQuery):
-    await callback.message.answer(get_leaderboard(RESULTS_FILE, LEADERS_TOP_N))
-    await callback.answer()
+    answer_later(callback)
+    await callback.message.answer(get_leaderboard())
 
 @router.callback_query(F.data == "start_quiz")
 async def start_quiz(callback: CallbackQuery, state: FSMContext):
@@ -99,70 +231,120 @@ async def start_quiz(callback: CallbackQuery, state: FSMContext):
 @router.message(Quiz.name)
 async def set_name(msg: Message, state: FSMContext):
     name = msg.text.strip()
-    await state.update_data(name=name, score=0, current_q=0)
     await msg.answer(f"Отлично, {name}! Поехали 🚀")
-    await send_next_question(msg, state, 0)
+    await send_next_question(msg, state, 0, {"name": name, "score": 0})
 
-async def send_next_question(msg_or_cb, state: FSMContext, qid: int):
-    data = await state.get_data()
-    if qid >= len(questions):
+async def send_next_question(msg_or_cb, state: FSMContext, qid: int, data: Dict[str, Any]):
+    if qid >= QUIZ_TOTAL:
         score = data.get("score", 0)
         name = data.get("name", "Без имени")
-        results = load_results(RESULTS_FILE)
-        results.append({"name": name, "score": score, "total": len(questions)})
-        save_results(RESULTS_FILE, results)
-        await msg_or_cb.answer(f"✅ Викторина окончена!\nТы набрал {score}/{len(questions)}.\n\n{get_leaderboard(RESULTS_FILE, LEADERS_TOP_N)}")
+        append_result({"name": name, "score": score, "total": QUIZ_TOTAL})
+        await msg_or_cb.answer(f"✅ Викторина окончена!\nТы набрал {score}/{QUIZ_TOTAL}.\n\n{get_leaderboard()}")
         await state.clear()
         return
     q = questions[qid]
-    await state.update_data(current_q=qid)
+    data["current_q"] = qid
     if q["type"] == "single":
-        await msg_or_cb.answer(q["question"], reply_markup=kb_single(q["options"], qid))
+        markup = q["_kb_single"]
     else:
-        await state.update_data(sel=[])
-        await msg_or_cb.answer(q["question"], reply_markup=kb_multi(q["options"], qid, set()))
+        data["sel_mask"] = 0
+        markup = kb_multi(q, 0)
+    await state.set_data(data)
+    await msg_or_cb.answer(q["question"], reply_markup=markup)
 
-@router.callback_query(F.data.startswith("s:"))
-async def single_answer(callback: CallbackQuery, state: FSMContext):
-    _, qid, idx = callback.data.split(":")
-    qid, idx = int(qid), int(idx)
-    q = questions[qid]
+async def single_answer(callback: CallbackQuery, state: FSMContext, qid: int, idx: int, _questions=questions):
+    answer_later(callback)
     data = await state.get_data()
-    score = data.get("score", 0)
-    if idx == q["answer_index"]:
-        score += 1
-    await state.update_data(score=score)
-    await send_next_question(callback.message, state, qid + 1)
-
-@router.callback_query(F.data.startswith("m:"))
-async def multi_select(callback: CallbackQuery, state: FSMContext):
-    qid = int(callback.data.split(":")[1])
-    idx = int(callback.data.split(":")[2])
+    # a repeated or stale tap must not score the question again
+    if qid != data.get("current_q"):
+        return
+    if idx == _questions[qid]["answer_index"]:
+        data["score"] = data.get("score", 0) + 1
+    await send_next_question(callback.message, state, qid + 1, data)
+
+async def multi_select(callback: CallbackQuery, state: FSMContext, qid: int, idx: int, _questions=questions):
+    answer_later(callback)
     data = await state.get_data()
-    sel = set(data.get("sel", []))
-    if idx in sel:
-        sel.remove(idx)
-    else:
-        sel.add(idx)
-    await state.update_data(sel=list(sel))
-    q = questions[qid]
-    await callback.message.edit_text(
-        q["question"],
-        reply_markup=kb_multi(q["options"], qid, sel)
-    )
+    # taps on an old question's keyboard must not touch the current selection
+    if qid == data.get("current_q"):
+        sel_mask = data["sel_mask"] = data.get("sel_mask", 0) ^ (1 << idx)
+        await state.set_data(data)
+        await callback.message.edit_reply_markup(reply_markup=kb_multi(_questions[qid], sel_mask))
 
-@router.callback_query(F.data.startswith("m_done:"))
-async def multi_done(callback: CallbackQuery, state: FSMContext):
-    qid = int(callback.data.split(":")[1])
+async def multi_done(callback: CallbackQuery, state: FSMContext, qid: int, idx: int, _questions=questions):
+    answer_later(callback)
     data = await state.get_data()
-    sel = set(data.get("sel", []))
-    q = questions[qid]
-    correct = set(q["answer_index"])
-    score = data.get("score", 0)
-    if sel == correct:
-        score += 1
-    await state.update_data(score=score, sel=[])
-    await send_next_question(callback.message, state, qid + 1)
+    # a repeated or stale "Готово" must not score the question again
+    if qid != data.get("current_q"):
+        return
+    q = _questions[qid]
+    if data.get("sel_mask", 0) == q["_correct_bits"]:
+        data["score"] = data.get("score", 0) + 1
+    data["sel_mask"] = 0
+    await send_next_question(callback.message, state, qid + 1, data)
+
+ANSWER_HANDLERS = {ACT_SINGLE: single_answer, ACT_MULTI: multi_select, ACT_DONE: multi_done}
+
+# the defaults bind hot-path globals as locals; aiogram only injects known names
+@router.callback_query(F.data.regexp(r"^[A-Za-z0-9_-]{6}$"))
+async def answer_callback(callback: CallbackQuery, state: FSMContext,
+                          _unpack=ANSWER_DATA.unpack, _b64decode=base64.urlsafe_b64decode,
+                          _handlers=ANSWER_HANDLERS):
+    action, qid, idx = _unpack(_b64decode(callback.data + "=="))
+    handler = _handlers.get(action)
+    if handler is not None:
+        await handler(callback, state, qid, idx)
+    else:
+        answer_later(callback, STALE_BUTTON_TEXT)
+
+# buttons from before the packed callback_data format, or anything else unknown
+@router.callback_query()
+async def stale_callback(callback: CallbackQuery):
+    answer_later(callback, STALE_BUTTON_TEXT)
+
+class LocalStorage(BaseStorage):
+    # MemoryStorage without the dict copies: get_data hands out the stored dict,
+    # which is fine because every handler here ends with set_data
+    def __init__(self):
+        self._states: Dict[StorageKey, str] = {}
+        self._data: Dict[StorageKey, Dict[str, Any]] = {}
+
+    async def close(self):
+        pass
+
+    async def set_state(self, key: StorageKey, state: StateType = None):
+        state = state.state if isinstance(state, State) else state
+        if state is None:
+            self._states.pop(key, None)
+        else:
+            self._states[key] = state
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._states.get(key)
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]):
+        if data:
+            self._data[key] = data if isinstance(data, dict) else dict(data)
+        else:
+            self._data.pop(key, None)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        # a fresh {} is not stored; handlers hand it back through set_data
+        data = self._data.get(key)
+        return {} if data is None else data
+
+def make_storage():
+    # only FSM state lives in Redis; results and the leaderboard are per process
+    # (_best/_top plus one results file), so the bot still needs a single worker
+    if not REDIS_URL:
+        return LocalStorage()
+    from aiogram.fsm.storage.redis import RedisStorage, DefaultKeyBuilder
+    return RedisStorage.from_url(
+        REDIS_URL,
+        key_builder=DefaultKeyBuilder(with_bot_id=True),
+        json_loads=json_loads,
+        json_dumps=json_dumps_str,
+    )
 
 async def on_startup(bot: Bot):
     await bot.set_webhook(WEBHOOK_URL)
@@ -171,8 +353,15 @@ async def on_shutdown(bot: Bot):
     await bot.delete_webhook()
 
 async def main():
-    bot = Bot(TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    dp = Dispatcher(storage=MemoryStorage())
+    global _results_queue
+    open_results(RESULTS_FILE)
+    _results_queue = asyncio.Queue()
+    writer = asyncio.create_task(results_writer(RESULTS_FILE, _results_queue))
+    writer.add_done_callback(writer_done)
+    # incoming webhook updates are decoded with bot.session.json_loads as well
+    session = AiohttpSession(json_loads=json_loads, json_dumps=json_dumps_str)
+    bot = Bot(TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    dp = Dispatcher(storage=make_storage())
     dp.include_router(router)
     app = web.Application()
     app["bot"] = bot
@@ -187,7 +376,32 @@ async def main():
     site = web.TCPSite(runner, "0.0.0.0", PORT)
     print(f"🚀 GrandPaQuiz_bot_web running on port {PORT}")
     await site.start()
-    await asyncio.Event().wait()
+    # Render stops the service with SIGTERM, which would skip the finally below
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        # let queued results reach the file before the writer goes away
+        if not writer.done():
+            await _results_queue.join()
+            writer.cancel()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        if sys.version_info >= (3, 12):
+            asyncio.run(main(), loop_factory=uvloop.new_event_loop)
+        else:
+            # uvloop.install() is deprecated on 3.12+, where loop_factory exists
+            uvloop.install()
+            asyncio.run(main())